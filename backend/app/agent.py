@@ -3,12 +3,23 @@ warnings.filterwarnings("ignore")
 
 import os
 import re
+import random
 import asyncio
-from typing import TypedDict, Literal, AsyncIterator
+import functools
+from collections import deque
+from collections.abc import Iterable, Sequence
+from typing import TypedDict, Literal, AsyncIterator, Awaitable, Callable, Optional
+
+try:
+    import hyperscan   # optional: SIMD multi-pattern matching for input scans
+except ImportError:
+    hyperscan = None
 
 from pydantic import BaseModel, Field
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import HumanMessage
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 
 from dotenv import load_dotenv
 load_dotenv('.env')
@@ -18,13 +29,25 @@ logger = get_logger(__name__)
 logger.info("Agent session started")
 
 import yaml
-with open("prompt.yaml", "r", encoding="utf-8") as f:
-    prompt_data = yaml.safe_load(f)
+try:
+    from yaml import CSafeLoader as _YamlLoader   # libyaml-backed
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+
+@functools.cache
+def _load_prompts() -> dict:
+    with open("prompt.yaml", "r", encoding="utf-8") as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
+
+prompt_data = _load_prompts()
 
 mermaid_prompt          = prompt_data["mermaid_prompt"]
 safety_prompt           = prompt_data["user_check_safety_prompt"]
 orchestrator_prompt     = prompt_data["orchestrator_prompt"]
 generale_purpose_prompt = prompt_data["generale_purpose_prompt"]
+user_input_prompt       = prompt_data["user_input_prompt"]
 
 from tool import web_search_tool, mermaid_syntax_check
 
@@ -46,22 +69,70 @@ INJECTION_PATTERNS = [
     r"jailbreak",
     r"dan mode",
 ]
-COMPILED_PATTERNS = [re.compile(p, re.IGNORECASE) for p in INJECTION_PATTERNS]
 
 CONTEXT_INJECTION_PATTERNS = [
-    re.compile(r"(ignore|disregard|forget).{0,30}(instruction|rule|prompt)", re.IGNORECASE),
-    re.compile(r"you are (now|a|an|DAN)", re.IGNORECASE),
-    re.compile(r"system prompt", re.IGNORECASE),
+    r"(ignore|disregard|forget).{0,30}(instruction|rule|prompt)",
+    r"you are (now|a|an|DAN)",
+    r"system prompt",
 ]
 
 
+def _union(patterns: list[str]) -> re.Pattern:
+    """One alternation regex, so each text is scanned once instead of once per pattern."""
+    return re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+
+
+def _hs_database(patterns: list[str]):
+    """Hyperscan block-mode database matching any of the patterns, caseless."""
+    db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    db.compile(
+        expressions=[p.encode() for p in patterns],
+        ids=list(range(len(patterns))),
+        elements=len(patterns),
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(patterns),
+    )
+    return db
+
+
+def _hs_search(db, text: str) -> bool:
+    hits = []
+    db.scan(text.encode(), match_event_handler=lambda *_: hits.append(True))
+    return bool(hits)
+
+
+INJECTION_RE         = _union(INJECTION_PATTERNS)
+CONTEXT_INJECTION_RE = _union(CONTEXT_INJECTION_PATTERNS)
+
+# Scans run on the event loop thread only, so each database's scratch is safe
+INJECTION_HS         = _hs_database(INJECTION_PATTERNS)         if hyperscan else None
+CONTEXT_INJECTION_HS = _hs_database(CONTEXT_INJECTION_PATTERNS) if hyperscan else None
+
+# Every match of each pattern list contains one of its needles, so ASCII
+# text without any of them can skip the regex. Keep in sync with the patterns.
+_INJECTION_NEEDLES = (
+    "ignore ", "you are now", "act as ", "forget ",
+    "repeat ", "disregard ", "jailbreak", "dan mode",
+)
+_CONTEXT_NEEDLES = ("ignore", "disregard", "forget", "you are ", "system prompt")
+
+
+def _matches(regex: re.Pattern, hs_db, needles: tuple[str, ...], text: str) -> bool:
+    # Non-ASCII text goes straight to the regex: IGNORECASE folds some
+    # Unicode look-alikes that str.lower() and Hyperscan's caseless mode do not.
+    if text.isascii():
+        low = text.lower()
+        if not any(n in low for n in needles):
+            return False
+        if hs_db is not None:
+            return _hs_search(hs_db, text)
+    return regex.search(text) is not None
+
+
+@functools.lru_cache(maxsize=256)
 def sanitize_input(text: str) -> tuple[str, bool]:
     if len(text) > MAX_INPUT_LENGTH:
         text = text[:MAX_INPUT_LENGTH]
-    for pattern in COMPILED_PATTERNS:
-        if pattern.search(text):
-            return text, True
-    return text, False
+    return text, _matches(INJECTION_RE, INJECTION_HS, _INJECTION_NEEDLES, text)
 
 
 # ─── State ────────────────────────────────────────────────────────────────────
@@ -80,10 +151,23 @@ class OrchestratorDecision(BaseModel):
     )
 
 
+VALID_ROUTES = frozenset({"workflow", "direct"})
+
+
 # ─── LLM clients ──────────────────────────────────────────────────────────────
 _base_llm   = ChatGoogleGenerativeAI(model="gemini-2.5-flash",      temperature=0.0)
 _safety_llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite", temperature=0.0)
 
+# Process-wide response cache keyed on (prompt, llm_string) — repeat queries
+# ("flowchart for login") skip the Gemini round trip. Applies to invoke/ainvoke
+# only: streamed tool-loop turns (astream) always go to the provider.
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+if LLM_CACHE_SIZE > 0:
+    set_llm_cache(InMemoryCache(maxsize=LLM_CACHE_SIZE))
+
+# .with_retry() covers invoke/ainvoke/batch only — streamed turns retry in _stream_turn
+STREAM_ATTEMPTS = 3
+
 structured_llm = (
     _base_llm
     .with_structured_output(OrchestratorDecision)
@@ -103,6 +187,28 @@ llm_mermaid = (
 )
 
 
+# ─── Local routing shortcut ───────────────────────────────────────────────────
+# Queries that clearly name a diagram type, or are just a greeting, route the
+# same way every time — skip the orchestrator round trip for those.
+_DIAGRAM_RE = re.compile(
+    r"\b(mermaid|flowcharts?|diagrams?|gantt|erd|uml|mindmaps?|state machines?)\b",
+    re.IGNORECASE,
+)
+_GREETINGS = frozenset({
+    "hi", "hello", "hey", "hiya", "yo", "good morning", "good afternoon",
+    "good evening", "thanks", "thank you", "thx",
+})
+
+
+def _fast_route(query: str) -> Optional[str]:
+    """Return "workflow"/"direct" for unambiguous queries, None to ask the LLM."""
+    if _DIAGRAM_RE.search(query):
+        return "workflow"
+    if len(query) < 20 and query.strip().lower().rstrip("!.? ") in _GREETINGS:
+        return "direct"
+    return None
+
+
 # ─── Safety check (flash-lite, plain text) ────────────────────────────────────
 _SAFETY_SYSTEM = (
     "You are a safety classifier. Respond with exactly one word.\n"
@@ -117,7 +223,8 @@ async def _check_safety(query: str) -> bool:
     """Returns True if safe, False if unsafe. Fails open on error."""
     try:
         response = await _safety_llm.ainvoke([
-            HumanMessage(content=f"{_SAFETY_SYSTEM}\n\nUser query: {query}")
+            SystemMessage(content=_SAFETY_SYSTEM),
+            HumanMessage(content=f"User query: {query}"),
         ])
         text    = response.content.strip().lower() if isinstance(response.content, str) else "safe"
         is_safe = "unsafe" not in text
@@ -129,20 +236,84 @@ async def _check_safety(query: str) -> bool:
 
 
 # ─── Helpers ──────────────────────────────────────────────────────────────────
-def extract_text_content(content) -> str:
+def _text_part(item) -> str:
+    """Text of one content block: plain strings as-is, dict blocks via 'text'."""
+    if isinstance(item, str):
+        return item
+    try:
+        return item["text"]
+    except (KeyError, TypeError):
+        return ""
+
+
+def extract_text_content(content, strip: bool = True) -> str:
     if isinstance(content, str):
-        return content.strip()
-    if isinstance(content, list):
-        parts = []
-        for item in content:
-            if isinstance(item, str):
-                parts.append(item)
-            elif isinstance(item, dict) and "text" in item:
-                parts.append(item["text"])
-        return "".join(parts).strip()
-    if isinstance(content, dict):
-        return content.get("text", str(content)).strip()
-    return str(content).strip()
+        text = content
+    elif isinstance(content, list):
+        text = "".join(map(_text_part, content))
+    elif isinstance(content, dict):
+        text = content.get("text", str(content))
+    else:
+        text = str(content)
+    return text.strip() if strip else text
+
+
+async def _run_tool(tool_call: dict, node_name: str):
+    tool_name = tool_call["name"]
+    tool_func = tool_map.get(tool_name)
+    logger.info(f"[{node_name}] Tool call: {tool_name}")
+    if not tool_func:
+        return f"Tool '{tool_name}' not found"
+    return await asyncio.to_thread(tool_func.invoke, tool_call["args"])
+
+
+class _EmptyCompletion(Exception):
+    """astream finished without yielding a single chunk (empty or blocked reply)."""
+
+
+async def _stream_turn(
+    llm_with_tools,
+    messages: list,
+    node_name: str,
+    on_token: Callable[[str], Awaitable[None]],
+    on_reset: Optional[Callable[[], Awaitable[None]]] = None,
+):
+    """
+    Stream one LLM turn, forwarding text until it turns out to be a tool call;
+    text already forwarded from such a turn is retracted through `on_reset`.
+    Transient failures and empty completions are retried (jittered backoff)
+    while nothing has been forwarded yet; once tokens reached the client a
+    retry would duplicate them. Always returns a message, never None.
+    """
+    for attempt in range(1, STREAM_ATTEMPTS + 1):
+        response  = None
+        forwarded = False
+        try:
+            async for chunk in llm_with_tools.astream(messages):
+                response = chunk if response is None else response + chunk
+                # Stop forwarding as soon as the turn turns out to be a tool call
+                if not response.tool_call_chunks:
+                    text = extract_text_content(chunk.content, strip=False)
+                    if text:
+                        forwarded = True
+                        await on_token(text)
+            if response is None:
+                raise _EmptyCompletion("no chunks streamed")
+            # Pre-tool-call text (e.g. an unvalidated diagram draft) is not the answer
+            if forwarded and response.tool_call_chunks and on_reset is not None:
+                await on_reset()
+            return response
+        except Exception as e:
+            if forwarded:
+                raise
+            if attempt == STREAM_ATTEMPTS:
+                if isinstance(e, _EmptyCompletion):
+                    # Empty or blocked completion on every attempt — an empty answer, not a crash
+                    logger.warning(f"[{node_name}] Empty completion after {STREAM_ATTEMPTS} attempts")
+                    return AIMessage(content="")
+                raise
+            logger.warning(f"[{node_name}] Stream attempt {attempt}/{STREAM_ATTEMPTS} failed, retrying: {e}")
+            await asyncio.sleep(random.uniform(0, 2 ** attempt))
 
 
 async def run_tool_loop(
@@ -150,41 +321,48 @@ async def run_tool_loop(
     initial_messages: list,
     max_iterations: int,
     node_name: str,
+    on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+    on_reset: Optional[Callable[[], Awaitable[None]]] = None,
+    on_turn:  Optional[Callable[[], Awaitable[None]]] = None,
 ) -> str:
     """
     Runs the LLM + tool loop to completion, returns the full text answer.
     Used for both direct (web search) and mermaid (syntax validation) workflows.
+
+    With `on_token`, each turn is streamed and its text forwarded as it
+    arrives. A turn that ends in tool calls is gathered in full before the
+    tools are dispatched, and any text it already forwarded is withdrawn via
+    `on_reset` — only the final (no tool call) turn's text is the answer.
+    `on_turn` fires at each tool-turn boundary, after the tools returned.
     """
-    messages  = list(initial_messages)
-    iteration = 0
+    messages = list(initial_messages)
 
-    while iteration < max_iterations:
-        iteration += 1
-        logger.info(f"[{node_name}] Iteration {iteration}/{max_iterations}")
+    for iteration in range(1, max_iterations + 1):
+        logger.debug(f"[{node_name}] Iteration {iteration}/{max_iterations}")
 
-        response = await llm_with_tools.ainvoke(messages)
+        if on_token is None:
+            response = await llm_with_tools.ainvoke(messages)
+        else:
+            response = await _stream_turn(llm_with_tools, messages, node_name, on_token, on_reset)
 
         # No tool calls — final answer reached
         if not getattr(response, "tool_calls", None):
             return extract_text_content(response.content)
 
-        # Resolve all tool calls then loop
+        # Resolve all tool calls concurrently, then loop
         messages.append(response)
-        for tool_call in response.tool_calls:
+        results = await asyncio.gather(*[
+            _run_tool(tool_call, node_name) for tool_call in response.tool_calls
+        ])
+        for tool_call, tool_result in zip(response.tool_calls, results):
             tool_name    = tool_call["name"]
-            tool_args    = tool_call["args"]
             tool_call_id = tool_call.get("id")
-            tool_func    = tool_map.get(tool_name)
-
-            logger.info(f"[{node_name}] Tool call: {tool_name}")
-            tool_result = (
-                await asyncio.to_thread(tool_func.invoke, tool_args)
-                if tool_func else f"Tool '{tool_name}' not found"
-            )
             tool_msg = {"role": "tool", "name": tool_name, "content": str(tool_result)}
             if tool_call_id:
                 tool_msg["tool_call_id"] = tool_call_id
             messages.append(tool_msg)
+        if on_turn is not None:
+            await on_turn()
 
     raise RuntimeError(f"{node_name} exceeded max iterations ({max_iterations})")
 
@@ -195,38 +373,115 @@ SAFE_REFUSAL = (
     "If you have another question or need help with a safe topic, I'm happy to help."
 )
 
-CONVERSATION_CONTEXT_LIMIT = int(os.getenv("CONVERSATION_CONTEXT_LIMIT", "10"))
+# ≥ 1: main's history query doubles as the ownership check (0 rows → 404)
+CONVERSATION_CONTEXT_LIMIT = max(1, int(os.getenv("CONVERSATION_CONTEXT_LIMIT", "10")))
 MAX_ITERATIONS             = int(os.getenv("AGENT_MAX_ITERATIONS", "5"))
+# Stream markers: discard the text streamed so far (it came from a tool-call
+# turn) / progress without text, so the consumer's idle clock restarts
+STREAM_RESET               = "__RESET__"
+STREAM_HEARTBEAT           = "__HEARTBEAT__"
+# Run the direct tool loop alongside the orchestrator; discarded if it routes elsewhere
+SPECULATIVE_ROUTE          = os.getenv("SPECULATIVE_ROUTE", "false").lower() in {"1", "true"}
+
+
+@functools.lru_cache(maxsize=1024)
+def _context_line(msg_type: str, content: str) -> str:
+    """Cached per message — each one reappears in the next LIMIT turns' context."""
+    if _matches(CONTEXT_INJECTION_RE, CONTEXT_INJECTION_HS, _CONTEXT_NEEDLES, content):
+        logger.warning(f"[CONTEXT] Stripped: {content[:80]}")
+        content = "[message removed]"
+    return f"{msg_type.upper()}: {content}"
+
+
+def _format_conversation_context(history: Iterable[dict]) -> str:
+    # Sequences are sliced only when over the limit; other iterables (e.g. a
+    # DB cursor or generator) are windowed without materialising a full list.
+    if isinstance(history, Sequence):
+        tail = history[-CONVERSATION_CONTEXT_LIMIT:] if len(history) > CONVERSATION_CONTEXT_LIMIT else history
+    else:
+        tail = deque(history, maxlen=CONVERSATION_CONTEXT_LIMIT)
+    if not tail:
+        return "No prior conversation context."
+    return "Prior conversation context:\n" + "\n".join(
+        _context_line(m.get("type", "unknown"), m.get("content", "")) for m in tail
+    )
 
 
-def _format_conversation_context(history: list[dict]) -> str:
-    if not history:
-        return "No prior conversation context."
-    formatted = "Prior conversation context:\n"
-    for msg in history[-CONVERSATION_CONTEXT_LIMIT:]:
-        content = msg.get("content", "")
-        if any(p.search(content) for p in CONTEXT_INJECTION_PATTERNS):
-            logger.warning(f"[CONTEXT] Stripped: {content[:80]}")
-            content = "[message removed]"
-        formatted += f"{msg.get('type', 'unknown').upper()}: {content}\n"
-    return formatted.strip()
+def _start_tool_loop(route: str, user_input: str) -> tuple[asyncio.Task, asyncio.Queue]:
+    """
+    Start the tool loop for `route` as a task. Tokens (plus STREAM_RESET when
+    streamed text is withdrawn, STREAM_HEARTBEAT after each tool turn), or a
+    single fallback message on failure, go into the returned queue, then a
+    None end marker.
+    """
+    if route == "workflow":
+        llm_with_tools, template, node_name = llm_mermaid, mermaid_prompt, "MERMAID"
+    else:
+        llm_with_tools, template, node_name = llm_direct, generale_purpose_prompt, "DIRECT"
+
+    queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+    streamed = False
+
+    async def on_token(text: str) -> None:
+        nonlocal streamed
+        streamed = True
+        queue.put_nowait(text)
+
+    async def on_reset() -> None:
+        nonlocal streamed
+        streamed = False
+        queue.put_nowait(STREAM_RESET)
+
+    async def on_turn() -> None:
+        queue.put_nowait(STREAM_HEARTBEAT)
+
+    async def produce() -> None:
+        try:
+            answer = await run_tool_loop(
+                llm_with_tools   = llm_with_tools,
+                initial_messages = [
+                    {"role": "system", "content": template},
+                    {"role": "user",   "content": user_input},
+                ],
+                max_iterations   = MAX_ITERATIONS,
+                node_name        = node_name,
+                on_token         = on_token,
+                on_reset         = on_reset,
+                on_turn          = on_turn,
+            )
+            if not streamed and answer:
+                queue.put_nowait(answer)
+        except RuntimeError as e:
+            logger.error(f"[STREAM] Tool loop exhausted: {e}")
+            queue.put_nowait("I couldn't complete the request within the allowed steps. Please try again.")
+        except Exception as e:
+            logger.error(f"[STREAM] Unexpected error: {e}", exc_info=True)
+            queue.put_nowait("An error occurred. Please try again.")
+        finally:
+            queue.put_nowait(None)
+
+    return asyncio.create_task(produce()), queue
 
 
 # ─── Main entry point ─────────────────────────────────────────────────────────
 async def stream_response(
     user_message: str,
-    conversation_history: list = None,
+    conversation_history: Optional[Iterable[dict]] = None,
 ) -> AsyncIterator[str]:
     """
-    Full pipeline — yields exactly two things:
-      1. The complete answer as a single chunk  (or SAFE_REFUSAL)
-      2. '__DONE__' sentinel
-
-    SSE value: decouples the HTTP connection from LLM latency.
-    No word-by-word simulation — the full answer arrives once the tool
-    loop completes, which is the right behaviour for both mermaid and direct.
+    Full pipeline — yields answer chunks as they arrive, then '__DONE__'.
+    A STREAM_RESET chunk means: drop everything yielded so far.
+    STREAM_HEARTBEAT chunks carry no text; they mark progress between the
+    silent steps (safety check, routing, each tool turn).
+
+    Refusals and error messages arrive as a single chunk. For normal answers
+    the final tool-loop turn is streamed token-by-token through a queue, so
+    the first chunk reaches the client after prefill rather than full decode.
     """
-    context = _format_conversation_context(conversation_history or [])
+    context = _format_conversation_context(conversation_history or ())
+    # Static system prompt first, per-request data strictly last — keeps the
+    # prompt prefix byte-identical across calls for provider-side caching.
+    user_input = user_input_prompt.format(query=user_message, conversation_context=context)
 
     # ── 1. Regex sanitizer (instant) ──
     _, flagged = sanitize_input(user_message)
@@ -242,50 +497,48 @@ async def stream_response(
         yield "__DONE__"
         return
 
-    # ── 3. Orchestrator routing ──
+    yield STREAM_HEARTBEAT
+
+    # ── 3. Orchestrator routing (keyword shortcut, else LLM) ──
+    route       = _fast_route(user_message)
+    speculative = None
     try:
-        decision = await structured_llm.ainvoke(
-            orchestrator_prompt.format(
-                query=user_message,
-                conversation_context=context,
-            )
-        )
-        route = decision.route if decision.route in {"workflow", "direct"} else "direct"
-    except Exception as e:
-        logger.warning(f"[STREAM] Orchestrator error, defaulting direct: {e}")
-        route = "direct"
+        if route is None:
+            if SPECULATIVE_ROUTE:
+                # Most traffic routes direct — start it while the orchestrator decides
+                speculative = _start_tool_loop("direct", user_input)
+            try:
+                decision = await structured_llm.ainvoke([
+                    SystemMessage(content=orchestrator_prompt),
+                    HumanMessage(content=user_input),
+                ])
+                route = decision.route if decision.route in VALID_ROUTES else "direct"
+            except Exception as e:
+                logger.warning(f"[STREAM] Orchestrator error, defaulting direct: {e}")
+                route = "direct"
+    except BaseException:
+        if speculative:
+            speculative[0].cancel()
+        raise
 
     logger.info(f"[STREAM] Route → {route}")
+    yield STREAM_HEARTBEAT
+
+    # ── 4. Run tool loop, final turn streamed through the queue ──
+    if speculative and route == "direct":
+        producer, queue = speculative
+    else:
+        if speculative:
+            speculative[0].cancel()
+        producer, queue = _start_tool_loop(route, user_input)
 
-    # ── 4. Run tool loop to completion ──
     try:
-        if route == "workflow":
-            answer = await run_tool_loop(
-                llm_with_tools   = llm_mermaid,
-                initial_messages = [{"role": "user", "content": mermaid_prompt.format(
-                    query=user_message, conversation_context=context,
-                )}],
-                max_iterations   = MAX_ITERATIONS,
-                node_name        = "MERMAID",
-            )
-        else:
-            answer = await run_tool_loop(
-                llm_with_tools   = llm_direct,
-                initial_messages = [{"role": "user", "content": generale_purpose_prompt.format(
-                    query=user_message, conversation_context=context,
-                )}],
-                max_iterations   = MAX_ITERATIONS,
-                node_name        = "DIRECT",
-            )
-    except RuntimeError as e:
-        logger.error(f"[STREAM] Tool loop exhausted: {e}")
-        answer = "I couldn't complete the request within the allowed steps. Please try again."
-    except Exception as e:
-        logger.error(f"[STREAM] Unexpected error: {e}", exc_info=True)
-        answer = "An error occurred. Please try again."
+        while (chunk := await queue.get()) is not None:
+            yield chunk
+    finally:
+        producer.cancel()
 
-    # ── 5. Yield full answer then sentinel ──
-    yield answer
+    # ── 5. Sentinel ──
     yield "__DONE__"
 
 
@@ -293,6 +546,8 @@ async def stream_response(
 async def get_response(user_message: str, conversation_history: list = None) -> str:
     parts = []
     async for chunk in stream_response(user_message, conversation_history):
-        if chunk != "__DONE__":
+        if chunk == STREAM_RESET:
+            parts.clear()
+        elif chunk not in ("__DONE__", STREAM_HEARTBEAT):
             parts.append(chunk)
     return "".join(parts) or "I couldn't generate a response. Please try again."
\ No newline at end of file
@@ -2,18 +2,23 @@
 Authentication: JWT access tokens + DB-backed refresh tokens + password reset.
 """
 import os
+import hmac
+import asyncio
 import hashlib
 import secrets
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
-from fastapi import Depends, HTTPException, status, APIRouter
+from fastapi import Depends, HTTPException, status, APIRouter, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
+import jwt
 import bcrypt
+from cachetools import TTLCache
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, exists
 
 from database import User, RefreshToken, PasswordResetToken, get_db
 
@@ -31,6 +36,19 @@ RESET_TOKEN_EXPIRE_MINUTES   = int(os.getenv("RESET_TOKEN_EXPIRE_MINUTES",   "60
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
+# Opt-in: remember bcrypt verdicts briefly so repeat logins skip the KDF.
+# Off by default — a cache hit is measurably faster than a miss.
+PASSWORD_VERIFY_CACHE = os.getenv("PASSWORD_VERIFY_CACHE", "false").lower() == "true"
+_VERIFY_HMAC_KEY      = hashlib.sha256(b"password-verify-cache:" + SECRET_KEY.encode()).digest()
+_verify_cache         = TTLCache(maxsize=4096, ttl=60)
+_verify_cache_lock    = threading.Lock()
+
+# Decoded access-token claims, keyed by SHA-256 of the token (raw tokens are
+# never stored). exp is re-checked on every hit, so no entry outlives its token.
+TOKEN_CACHE_TTL   = int(os.getenv("TOKEN_CACHE_TTL", "30"))
+_token_cache      = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+_token_cache_lock = threading.Lock()
+
 
 # ─── Helpers ──────────────────────────────────────────────────────────────────
 def _hash_token(raw: str) -> str:
@@ -42,18 +60,49 @@ def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
 
 
-def verify_password(plain: str, hashed: str) -> bool:
+def _checkpw(plain: str, hashed: str) -> bool:
     try:
         return bcrypt.checkpw(plain.encode("utf-8"), hashed.encode("utf-8"))
     except Exception:
         return False
 
 
+def verify_password(plain: str, hashed: str) -> bool:
+    if not PASSWORD_VERIFY_CACHE:
+        return _checkpw(plain, hashed)
+
+    # Keyed on an HMAC of the password — the plaintext is never stored
+    key = (hashed, hmac.new(_VERIFY_HMAC_KEY, plain.encode("utf-8"), hashlib.sha256).digest())
+    with _verify_cache_lock:
+        cached = _verify_cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = _checkpw(plain, hashed)
+    with _verify_cache_lock:
+        _verify_cache[key] = result
+    return result
+
+
 def create_access_token(user_id: str) -> str:
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     return jwt.encode({"sub": user_id, "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def decode_access_token(token: str) -> dict:
+    """Verify an access token and return its claims. Raises jwt.PyJWTError."""
+    key = hashlib.sha256(token.encode()).digest()
+    with _token_cache_lock:
+        payload = _token_cache.get(key)
+    if payload is not None and payload["exp"] > time.time():
+        return payload
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp"]})
+    with _token_cache_lock:
+        _token_cache[key] = payload
+    return payload
+
+
 async def create_refresh_token(user_id: str, db: AsyncSession) -> str:
     """Generate a random refresh token, store its hash in DB, return raw token."""
     raw        = secrets.token_urlsafe(64)
@@ -96,26 +145,33 @@ class ResetPasswordRequest(BaseModel):
 
 # ─── FastAPI dependencies ─────────────────────────────────────────────────────
 async def get_current_user(
+    request: Request,
     token: str = Depends(oauth2_scheme),
     db: AsyncSession = Depends(get_db),
 ) -> User:
+    # Resolved once per request; later lookups (nested deps, handlers) reuse it
+    user = getattr(request.state, "user", None)
+    if user is not None:
+        return user
+
     exc = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload  = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload  = decode_access_token(token)
         user_id: str = payload.get("sub")
         if not user_id:
             raise exc
-    except JWTError:
+    except jwt.PyJWTError:
         raise exc
 
     result = await db.execute(select(User).where(User.id == user_id))
     user   = result.scalar_one_or_none()
     if not user:
         raise exc
+    request.state.user = user
     return user
 
 
@@ -131,15 +187,17 @@ auth_router = APIRouter(prefix="/api/auth", tags=["auth"])
 
 @auth_router.post("/register", response_model=TokenResponse, status_code=201)
 async def register(body: UserRegister, db: AsyncSession = Depends(get_db)):
-    existing = await db.execute(select(User).where(User.email == body.email))
-    if existing.scalar_one_or_none():
+    email_taken = await db.scalar(select(exists().where(User.email == body.email)))
+    if email_taken:
         raise HTTPException(status_code=400, detail="Email already registered")
     if len(body.password) < 8:
         raise HTTPException(status_code=400, detail="Password must be at least 8 characters")
     if len(body.password) > 72:
         raise HTTPException(status_code=400, detail="Password must be under 72 characters")
 
-    user = User(email=body.email, hashed_password=hash_password(body.password))
+    # bcrypt is ~100 ms of CPU — keep it off the event loop
+    hashed = await asyncio.to_thread(hash_password, body.password)
+    user   = User(email=body.email, hashed_password=hashed)
     db.add(user)
     await db.commit()
     await db.refresh(user)
@@ -154,7 +212,7 @@ async def register(body: UserRegister, db: AsyncSession = Depends(get_db)):
 async def login(form: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(User).where(User.email == form.username))
     user   = result.scalar_one_or_none()
-    if not user or not verify_password(form.password, user.hashed_password):
+    if not user or not await asyncio.to_thread(verify_password, form.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -202,7 +260,6 @@ async def refresh(body: RefreshRequest, db: AsyncSession = Depends(get_db)):
 async def forgot_password(body: ForgotPasswordRequest, db: AsyncSession = Depends(get_db)):
     """Always returns 200 to avoid email enumeration."""
     from email_service import send_password_reset_email  # local import avoids circular dep
-    import asyncio
 
     result = await db.execute(select(User).where(User.email == body.email))
     user   = result.scalar_one_or_none()
@@ -249,7 +306,7 @@ async def reset_password(body: ResetPasswordRequest, db: AsyncSession = Depends(
     if not user:
         raise HTTPException(status_code=400, detail="User not found")
 
-    user.hashed_password = hash_password(body.new_password)
+    user.hashed_password = await asyncio.to_thread(hash_password, body.new_password)
     stored.used          = True
 
     # Revoke all existing refresh tokens on password reset
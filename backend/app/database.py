@@ -2,9 +2,11 @@
 Database setup — default to Neon (Postgres). SQLite fallback for local dev.
 """
 import os
+import time
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.pool import NullPool
 from sqlalchemy.orm import DeclarativeBase, relationship
-from sqlalchemy import Column, String, DateTime, ForeignKey, Text, Boolean
+from sqlalchemy import Column, String, DateTime, ForeignKey, Text, Boolean, Index, event, func
 import uuid
 from datetime import datetime, timezone
 
@@ -13,11 +15,49 @@ DATABASE_URL = os.getenv("DATABASE_URL", "")
 # Strip query params — pass SSL cleanly via connect_args for asyncpg
 _clean_url = DATABASE_URL.split("?")[0]
 
-engine = create_async_engine(
-    _clean_url,
-    echo=False,
-    connect_args={"ssl": "require"},
-)
+if _clean_url.startswith("sqlite"):
+    engine = create_async_engine(_clean_url, echo=False)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL + NORMAL: commits stop fsync-ing the main file every write.
+        # foreign_keys: SQLite ignores ON DELETE CASCADE unless it is switched on.
+        cursor = dbapi_conn.cursor()
+        for pragma in (
+            "PRAGMA foreign_keys=ON",
+            "PRAGMA journal_mode=WAL",
+            "PRAGMA synchronous=NORMAL",
+            "PRAGMA temp_store=MEMORY",
+            "PRAGMA mmap_size=268435456",
+        ):
+            cursor.execute(pragma)
+        cursor.close()
+elif os.getenv("DB_NULL_POOL", "false").lower() == "true":
+    # Behind PgBouncer (transaction mode) — let the bouncer do the pooling.
+    # Prepared statements don't survive a backend switch: no caching on either
+    # layer, and unique names so the dialect's explicit prepares can't collide.
+    engine = create_async_engine(
+        _clean_url,
+        echo=False,
+        connect_args={
+            "ssl":                           "require",
+            "statement_cache_size":          0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func":  lambda: f"__asyncpg_{uuid.uuid4()}__",
+        },
+        poolclass=NullPool,
+    )
+else:
+    engine = create_async_engine(
+        _clean_url,
+        echo=False,
+        connect_args={"ssl": "require"},
+        pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),   # before Neon/LB idle cutoffs
+        pool_pre_ping=True,
+    )
 
 AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
@@ -26,13 +66,30 @@ class Base(DeclarativeBase):
     pass
 
 
-def _now() -> datetime:
+def _utcnow() -> datetime:
     return datetime.now(timezone.utc)
 
 
+# Postgres stamps rows with its own now(). SQLite's CURRENT_TIMESTAMP is naive
+# and whole-second, so there the aware UTC value is built in Python — the same
+# kind of value persist_turn binds into updated_at.
+_now = _utcnow if _clean_url.startswith("sqlite") else func.now()
+
+
+def _uuid7() -> str:
+    """
+    Time-ordered UUIDv7 (RFC 9562): 48-bit ms timestamp, then random bits.
+    Consecutive inserts land next to each other in the primary-key B-tree.
+    """
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    value = (value & ~(0xF << 76)) | (0x7 << 76)   # version 7
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)   # RFC 4122 variant
+    return str(uuid.UUID(int=value))
+
+
 class User(Base):
     __tablename__ = "users"
-    id              = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id              = Column(String, primary_key=True, default=_uuid7)
     email           = Column(String, unique=True, nullable=False, index=True)
     hashed_password = Column(String, nullable=False)
     is_active       = Column(Boolean, default=True)
@@ -46,7 +103,7 @@ class User(Base):
 class RefreshToken(Base):
     """Long-lived, revocable token stored server-side."""
     __tablename__ = "refresh_tokens"
-    id         = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id         = Column(String, primary_key=True, default=_uuid7)
     user_id    = Column(String, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     token_hash = Column(String, nullable=False, unique=True)  # SHA-256 of raw token
     expires_at = Column(DateTime(timezone=True), nullable=False)
@@ -58,7 +115,7 @@ class RefreshToken(Base):
 class PasswordResetToken(Base):
     """Single-use token for password reset."""
     __tablename__ = "password_reset_tokens"
-    id         = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id         = Column(String, primary_key=True, default=_uuid7)
     user_id    = Column(String, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     token_hash = Column(String, nullable=False, unique=True)
     expires_at = Column(DateTime(timezone=True), nullable=False)
@@ -69,29 +126,42 @@ class PasswordResetToken(Base):
 
 class Conversation(Base):
     __tablename__ = "conversations"
-    id         = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id    = Column(String, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    id         = Column(String, primary_key=True, default=_uuid7)
+    user_id    = Column(String, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     title      = Column(String, default="New Conversation")
     created_at = Column(DateTime(timezone=True), default=_now)
-    updated_at = Column(DateTime(timezone=True), default=_now)
+    updated_at = Column(DateTime(timezone=True), default=_now, onupdate=_now)
     user     = relationship("User", back_populates="conversations", lazy="noload")
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan",
                             lazy="noload", order_by="Message.created_at")
+    # Serves the sidebar listing: WHERE user_id = ? ORDER BY updated_at DESC
+    __table_args__ = (Index("ix_conv_user_updated", "user_id", "updated_at"),)
 
 
 class Message(Base):
     __tablename__ = "messages"
-    id              = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    conversation_id = Column(String, ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False, index=True)
+    id              = Column(String, primary_key=True, default=_uuid7)
+    conversation_id = Column(String, ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
     role            = Column(String, nullable=False)
     content         = Column(Text, nullable=False)
     created_at      = Column(DateTime(timezone=True), default=_now)
     conversation = relationship("Conversation", back_populates="messages", lazy="noload")
+    # History/messages reads: WHERE conversation_id = ? ORDER BY created_at LIMIT n.
+    # Its leading column also covers plain conversation_id lookups and the FK cascade.
+    __table_args__ = (Index("ix_msg_conv_created", "conversation_id", "created_at"),)
+
+
+def _create_all(sync_conn):
+    Base.metadata.create_all(sync_conn)
+    # create_all skips tables that already exist — add indexes introduced since
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
 
 
 async def create_tables():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_all)
 
 
 async def get_db():
@@ -3,43 +3,67 @@ Shared logger
 
 """
 import os
-import json
+import time
+import queue
+import atexit
 import logging
 import logging.handlers
-from datetime import datetime, timezone
+
+import orjson
 
 from context import request_id_var
 
 # ─── JSON formatter ───────────────────────────────────────────────────────────
 
+# Standard LogRecord attributes — everything else came in via extra={}
+_SKIP = frozenset({
+    "msg", "args", "levelname", "levelno", "pathname", "filename",
+    "module", "exc_info", "exc_text", "stack_info", "lineno",
+    "funcName", "created", "msecs", "relativeCreated", "thread",
+    "threadName", "processName", "process", "name", "message",
+    "request_id",
+})
+
+
 class JSONFormatter(logging.Formatter):
     """Emit each log record as a single JSON line."""
 
+    # Attribute count of a record created without extra={} (+1 for the
+    # request_id stamped by the queue handler); anything larger means extras
+    # are present and worth scanning for.
+    _BASE_ATTRS = len(logging.LogRecord("", logging.INFO, "", 0, "", (), None).__dict__) + 1
+
+    # (epoch second, "YYYY-MM-DDTHH:MM:SS") — swapped as one tuple so threads
+    # never see a second paired with another second's prefix
+    _ts_cache: tuple[int, str] = (-1, "")
+
+    def _timestamp(self, created: float) -> str:
+        """UTC ISO-8601 timestamp; the seconds prefix is formatted once per second."""
+        sec = int(created)
+        cached_sec, prefix = self._ts_cache
+        if cached_sec != sec:
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+            self._ts_cache = (sec, prefix)
+        return f"{prefix}.{int((created - sec) * 1_000_000):06d}+00:00"
+
     def format(self, record: logging.LogRecord) -> str:
         log_obj = {
-            "timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "timestamp": self._timestamp(record.created),
             "level":     record.levelname,
             "logger":    record.name,
             "message":   record.getMessage(),
             "module":    record.module,
             "line":      record.lineno,
-            "request_id": request_id_var.get(),
+            "request_id": getattr(record, "request_id", None) or request_id_var.get(),
         }
         if record.exc_info:
             log_obj["exception"] = self.formatException(record.exc_info)
 
         # Include any extra fields passed via extra={} in log calls
-        _SKIP = {
-            "msg", "args", "levelname", "levelno", "pathname", "filename",
-            "module", "exc_info", "exc_text", "stack_info", "lineno",
-            "funcName", "created", "msecs", "relativeCreated", "thread",
-            "threadName", "processName", "process", "name", "message",
-        }
-        for key, val in record.__dict__.items():
-            if key not in _SKIP:
-                log_obj[key] = val
+        if len(record.__dict__) > self._BASE_ATTRS:
+            log_obj.update({k: v for k, v in record.__dict__.items() if k not in _SKIP})
 
-        return json.dumps(log_obj)
+        return orjson.dumps(log_obj, default=str).decode()
 
 
 # ─── Handlers (configured once at import time) ────────────────────────────────
@@ -58,7 +82,30 @@ _rotating_handler.setFormatter(JSONFormatter())
 _console_handler = logging.StreamHandler()
 _console_handler.setFormatter(JSONFormatter())
 
-logging.basicConfig(level=logging.INFO, handlers=[_rotating_handler, _console_handler])
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records for the listener thread, keeping what formatting needs."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener thread has no request context — capture it now.
+        # Unlike the stock prepare, exc_info is kept so JSONFormatter can
+        # still render the traceback.
+        record.request_id = request_id_var.get()
+        record.msg  = record.getMessage()
+        record.args = None
+        return record
+
+
+# Request paths only enqueue; JSON encoding and file I/O happen on the
+# listener's background thread.
+_log_queue    = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, _rotating_handler, _console_handler, respect_handler_level=True,
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[_ContextQueueHandler(_log_queue)])
 
 
 # ─── Public helper ────────────────────────────────────────────────────────────
@@ -2,29 +2,32 @@
 FastAPI backend — SSE streaming, proper error handling, token refresh.
 """
 import os
-import uuid
+import time
+import anyio
 import asyncio
-import json
+import orjson
 from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Optional, AsyncIterator
-from jose import jwt
 
 from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from starlette.datastructures import MutableHeaders
 from pydantic import BaseModel
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, insert, update, delete, func, bindparam, case
 
-from agent import stream_response, get_response, logger, CONVERSATION_CONTEXT_LIMIT
-from auth import auth_router, require_active_user
-from database import create_tables, get_db, User, Conversation, Message
+from agent import stream_response, get_response, logger, CONVERSATION_CONTEXT_LIMIT, STREAM_RESET, STREAM_HEARTBEAT
+from auth import auth_router, require_active_user, decode_access_token
+from database import create_tables, get_db, AsyncSessionLocal, User, Conversation, Message
+from context import request_id_var
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -34,18 +37,38 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY environment variable is not set.")
 
+# Max silence from the agent before the request is abandoned. The clock restarts
+# on every token and heartbeat, so it bounds one step — safety + routing, or a
+# single tool turn (LLM call + tools, mmdc alone can take 15 s) — not the whole loop.
+STREAM_IDLE_TIMEOUT = int(os.getenv("STREAM_IDLE_TIMEOUT", "90"))
+
 # ─── Rate limiter ──────────────────────────────────────────────────────────────
+def _rate_limit_key(request: Request) -> str:
+    auth = request.headers.get("Authorization", "")
+    # Anonymous traffic (static files, preflights) skips the decode entirely
+    if not auth.startswith("Bearer ") or len(auth) == 7:
+        return get_remote_address(request)
+    try:
+        # Shares auth's TTL cache — a warm token is a dict lookup, not an HMAC
+        payload = decode_access_token(auth[7:])
+        return f"user:{payload.get('sub', get_remote_address(request))}"
+    except Exception:
+        return get_remote_address(request)
+
+
 def get_user_or_ip(request: Request) -> str:
-    token = request.headers.get("Authorization", "")
-    if token:
-        try:
-            payload = jwt.decode(token.replace("Bearer ", ""), SECRET_KEY, algorithms=["HS256"])
-            return f"user:{payload.get('sub', get_remote_address(request))}"
-        except Exception:
-            pass
-    return get_remote_address(request)
+    # Computed once per request, however many limits are evaluated
+    key = getattr(request.state, "rl_key", None)
+    if key is None:
+        key = request.state.rl_key = _rate_limit_key(request)
+    return key
 
-limiter = Limiter(key_func=get_user_or_ip)
+# Shared storage keeps one quota across uvicorn workers; memory:// is per-process
+limiter = Limiter(
+    key_func=get_user_or_ip,
+    storage_uri=os.getenv("REDIS_URL", "memory://"),
+    strategy="moving-window",
+)
 
 
 @asynccontextmanager
@@ -55,7 +78,7 @@ async def lifespan(app: FastAPI):
     yield
 
 
-app = FastAPI(title="Mermaid AI Assistant", lifespan=lifespan)
+app = FastAPI(title="Mermaid AI Assistant", lifespan=lifespan, default_response_class=ORJSONResponse)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -81,15 +104,34 @@ else:
 
 
 # ─── Request ID middleware ─────────────────────────────────────────────────────
-@app.middleware("http")
-async def attach_request_id(request: Request, call_next):
-    from context import request_id_var
-    req_id = str(uuid.uuid4())[:8]
-    request_id_var.set(req_id)
-    request.state.request_id = req_id
-    response = await call_next(request)
-    response.headers["X-Request-ID"] = req_id
-    return response
+class RequestIDMiddleware:
+    """
+    Pure ASGI: no BaseHTTPMiddleware task or body re-streaming. The ID stays
+    bound for the whole response, streamed SSE bodies included.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        req_id = os.urandom(4).hex()   # 8 hex chars, no UUID object
+        scope.setdefault("state", {})["request_id"] = req_id   # → request.state.request_id
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Request-ID", req_id)
+            await send(message)
+
+        token = request_id_var.set(req_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)   # don't leak this ID into whatever runs next
+
+
+app.add_middleware(RequestIDMiddleware)
 
 
 app.include_router(auth_router)
@@ -104,20 +146,96 @@ class PromptRequest(BaseModel):
     conversation_id: str
 
 
+# ─── Prebuilt statements ─────────────────────────────────────────────────────
+# Built once at import; per-request values travel as bind parameters, so each
+# call skips statement construction and hits SQLAlchemy's compiled-SQL cache.
+# Read paths select plain columns: rows map straight to JSON, no ORM hydration.
+_uid = bindparam("uid")
+_cid = bindparam("cid")
+
+_user_msg_counts = (
+    select(Message.conversation_id, func.count(Message.id).label("cnt"))
+    .join(Conversation, Conversation.id == Message.conversation_id)
+    .where(Conversation.user_id == _uid)   # only this user's messages
+    .group_by(Message.conversation_id).subquery()
+)
+CONVERSATION_PAGE_STMT = (
+    select(
+        Conversation.id, Conversation.title, Conversation.created_at, Conversation.updated_at,
+        func.coalesce(_user_msg_counts.c.cnt, 0).label("message_count"),
+    )
+    .outerjoin(_user_msg_counts, Conversation.id == _user_msg_counts.c.conversation_id)
+    .where(Conversation.user_id == _uid)
+    .order_by(Conversation.updated_at.desc())
+    .offset(bindparam("offset")).limit(bindparam("limit"))
+)
+# Ownership filter + delete in one statement; no row returned → not found
+DELETE_OWNED_CONVERSATION_STMT = (
+    delete(Conversation)
+    .where(Conversation.id == _cid, Conversation.user_id == _uid)
+    .returning(Conversation.id)
+    .execution_options(synchronize_session=False)
+)
+# Ownership check folded in: an owned but empty conversation yields one all-NULL message row
+MESSAGES_STMT = (
+    select(Message.id, Message.role, Message.content, Message.created_at)
+    .select_from(Conversation)
+    .outerjoin(Message, Message.conversation_id == Conversation.id)
+    .where(Conversation.id == _cid, Conversation.user_id == _uid)
+    .order_by(Message.created_at.asc())
+    .limit(bindparam("limit"))
+)
+# Outer join so an empty conversation still yields its (title, None, None) row
+PROMPT_HISTORY_STMT = (
+    select(Conversation.title, Message.role, Message.content)
+    .select_from(Conversation)
+    .outerjoin(Message, Message.conversation_id == Conversation.id)
+    .where(Conversation.id == _cid, Conversation.user_id == _uid)
+    .order_by(Message.created_at.desc())
+    .limit(CONVERSATION_CONTEXT_LIMIT)
+)
+# Title is only replaced while it is still the default
+TOUCH_CONVERSATION_STMT = (
+    update(Conversation)
+    .where(Conversation.id == _cid)
+    .values(
+        updated_at=bindparam("ts"),
+        title=case((Conversation.title == "New Conversation", bindparam("new_title")),
+                   else_=Conversation.title),
+    )
+    .execution_options(synchronize_session=False)   # save session holds no objects
+)
+INSERT_MESSAGES_STMT = insert(Message)
+
+
 # ─── Health ────────────────────────────────────────────────────────────────────
+HEALTH_CACHE_SECONDS = 5.0
+_health_cache: tuple[float, Optional[dict]] = (0.0, None)   # (checked_at, body)
+
+
 @app.get("/health")
-async def health(db: AsyncSession = Depends(get_db)):
+async def health():
+    # Probes hit this every few seconds per pod — reuse a fresh verdict
+    global _health_cache
+    now = time.monotonic()
+    checked_at, cached = _health_cache
+    if cached is not None and now - checked_at < HEALTH_CACHE_SECONDS:
+        return cached
+
     try:
-        await db.execute(select(1))
+        async with AsyncSessionLocal() as db:
+            await db.execute(select(1))
         db_status = "ok"
     except Exception as e:
         db_status = f"error"
         logger.error(f"[HEALTH] DB check failed: {e}")
-    return {
+    body = {
         "status":    "ok" if db_status == "ok" else "degraded",
         "db":        db_status,
         "timestamp": datetime.now(timezone.utc).isoformat(),
     }
+    _health_cache = (now, body)
+    return body
 
 
 # ─── Conversations ─────────────────────────────────────────────────────────────
@@ -134,24 +252,12 @@ async def list_conversations(
     if page_size > 50: page_size = 50
     offset = (page - 1) * page_size
 
-    msg_count_subq = (
-        select(Message.conversation_id, func.count(Message.id).label("cnt"))
-        .group_by(Message.conversation_id).subquery()
-    )
     result = await db.execute(
-        select(Conversation, func.coalesce(msg_count_subq.c.cnt, 0).label("message_count"))
-        .outerjoin(msg_count_subq, Conversation.id == msg_count_subq.c.conversation_id)
-        .where(Conversation.user_id == current_user.id)
-        .order_by(Conversation.updated_at.desc())
-        .offset(offset).limit(page_size)
+        CONVERSATION_PAGE_STMT,
+        {"uid": current_user.id, "offset": offset, "limit": page_size},
     )
-    rows = result.all()
     return {
-        "conversations": [
-            {"id": c.id, "title": c.title, "created_at": c.created_at,
-             "updated_at": c.updated_at, "message_count": count}
-            for c, count in rows
-        ],
+        "conversations": [r._asdict() for r in result],
         "page": page, "page_size": page_size,
     }
 
@@ -164,12 +270,8 @@ async def create_conversation(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(require_active_user),
 ):
-    conv = Conversation(
-        id=str(uuid.uuid4()),
-        user_id=current_user.id,
-        title=body.title or "New Conversation",
-        updated_at=datetime.now(timezone.utc),
-    )
+    # created_at / updated_at are stamped by the column default in the INSERT
+    conv = Conversation(user_id=current_user.id, title=body.title or "New Conversation")
     db.add(conv)
     await db.commit()
     await db.refresh(conv)
@@ -186,16 +288,12 @@ async def delete_conversation(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(require_active_user),
 ):
+    # Messages go with it through the FK's ON DELETE CASCADE
     result = await db.execute(
-        select(Conversation).where(
-            Conversation.id == conversation_id,
-            Conversation.user_id == current_user.id,
-        )
+        DELETE_OWNED_CONVERSATION_STMT, {"cid": conversation_id, "uid": current_user.id}
     )
-    conv = result.scalar_one_or_none()
-    if not conv:
+    if result.first() is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    await db.delete(conv)
     await db.commit()
     return {"message": "Conversation deleted"}
 
@@ -209,31 +307,25 @@ async def get_messages(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(require_active_user),
 ):
-    conv_result = await db.execute(
-        select(Conversation).where(
-            Conversation.id == conversation_id,
-            Conversation.user_id == current_user.id,
-        )
-    )
-    if not conv_result.scalar_one_or_none():
-        raise HTTPException(status_code=404, detail="Conversation not found")
-
     msg_result = await db.execute(
-        select(Message)
-        .where(Message.conversation_id == conversation_id)
-        .order_by(Message.created_at.asc())
-        .limit(min(limit, 100))
+        MESSAGES_STMT,
+        # LIMIT ≥ 1: the ownership check rides on this query, and 0 rows means 404
+        {"cid": conversation_id, "uid": current_user.id, "limit": max(1, min(limit, 100))},
     )
-    messages = msg_result.scalars().all()
+    rows = msg_result.all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Conversation not found")
     return {
-        "messages": [
-            {"id": m.id, "role": m.role, "content": m.content, "created_at": m.created_at}
-            for m in messages
-        ]
+        "messages": [m._asdict() for m in rows if m.id is not None]
     }
 
 
 # ─── Streaming prompt ──────────────────────────────────────────────────────────
+def _sse(event: dict) -> bytes:
+    """One SSE frame. orjson escapes newlines, so content can't break framing."""
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+
 @app.post("/api/prompt/stream")
 @limiter.limit("20/minute")
 async def handle_prompt_stream(
@@ -246,19 +338,18 @@ async def handle_prompt_stream(
     SSE endpoint. Streams LLM response chunks as they arrive.
     Events:
       data: {"type": "chunk",  "content": "..."}
+      data: {"type": "reset"}                  ← discard chunks so far (tool-call turn)
       data: {"type": "done",   "conversation_id": "..."}
       data: {"type": "error",  "message": "..."}
     """
-    # ── Validate conversation ownership ──
-    conv_result = await db.execute(
-        select(Conversation).where(
-            Conversation.id == body.conversation_id,
-            Conversation.user_id == current_user.id,
-        )
+    # ── Ownership check + history in one round-trip ──
+    history_result = await db.execute(
+        PROMPT_HISTORY_STMT, {"cid": body.conversation_id, "uid": current_user.id}
     )
-    conv = conv_result.scalar_one_or_none()
-    if not conv:
+    rows = history_result.all()
+    if not rows:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    conv_id = body.conversation_id
 
     user_message = body.message.strip()
     if not user_message:
@@ -266,63 +357,82 @@ async def handle_prompt_stream(
     if len(user_message) > 8000:
         raise HTTPException(status_code=400, detail="Message too long (max 8000 chars)")
 
-    # ── Save user message ──
-    db.add(Message(conversation_id=conv.id, role="user", content=user_message))
-    await db.flush()
-
-    history_result = await db.execute(
-        select(Message)
-        .where(Message.conversation_id == conv.id)
-        .order_by(Message.created_at.desc())
-        .limit(CONVERSATION_CONTEXT_LIMIT)
-    )
-    context = [
-        {"type": m.role, "content": m.content}
-        for m in reversed(history_result.scalars().all())
+    # The user message is written together with the reply once streaming ends.
+    # Context is prior turns only — the new message already goes in as {query}.
+    asked_at = datetime.now(timezone.utc)
+    context  = [
+        {"type": r.role, "content": r.content}
+        for r in reversed(rows) if r.role is not None
     ]
-    await db.commit()
+    # Release the pooled connection now — it is not needed while the LLM streams
+    await db.close()
+
+    logger.info(f"[{current_user.email}][{conv_id}] STREAM START: {user_message[:80]}")
 
-    logger.info(f"[{current_user.email}][{conv.id}] STREAM START: {user_message[:80]}")
+    async def persist_turn(reply: str) -> None:
+        """Write the user message (+ reply, if any) and touch the conversation in one commit."""
+        try:
+            async with AsyncSessionLocal() as save_session:
+                saved_at = datetime.now(timezone.utc)
+                touched  = await save_session.execute(TOUCH_CONVERSATION_STMT, {
+                    "cid":       conv_id,
+                    "ts":        saved_at,
+                    "new_title": user_message[:50] + ("..." if len(user_message) > 50 else ""),
+                })
+                if touched.rowcount:   # 0 → conversation was deleted mid-stream
+                    # Explicit timestamps keep user → assistant order within one transaction
+                    rows = [{"conversation_id": conv_id, "role": "user",
+                             "content": user_message, "created_at": asked_at}]
+                    if reply:
+                        rows.append({"conversation_id": conv_id, "role": "assistant",
+                                     "content": reply, "created_at": saved_at})
+                    await save_session.execute(INSERT_MESSAGES_STMT, rows)   # one executemany batch
+                    await save_session.commit()
+                    if reply:
+                        logger.info(f"[{current_user.email}][{conv_id}] Saved: {reply[:80]}")
+        except Exception as e:
+            logger.error(f"[STREAM] Save failed: {e}", exc_info=True)
 
-    async def event_generator() -> AsyncIterator[str]:
+    async def event_generator() -> AsyncIterator[bytes]:
         full_response = ""
+        stream = stream_response(user_message, context)
         try:
-            async for chunk in stream_response(user_message, context):
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(stream), STREAM_IDLE_TIMEOUT)
+                except StopAsyncIteration:
+                    break
                 if chunk == "__DONE__":
                     break
-                full_response = chunk  # single chunk — just capture it
-                payload = json.dumps({"type": "chunk", "content": chunk})
-                yield f"data: {payload}\n\n"
+                if chunk == STREAM_HEARTBEAT:
+                    # SSE comment: ignored by the client, keeps proxies from idling out
+                    yield b": keepalive\n\n"
+                    continue
+                if chunk == STREAM_RESET:
+                    # Text so far came from a tool-call turn — neither shown nor saved
+                    full_response = ""
+                    yield _sse({"type": "reset"})
+                    continue
+                full_response += chunk
+                yield _sse({"type": "chunk", "content": chunk})
 
         except asyncio.CancelledError:
-            logger.info(f"[{current_user.email}][{conv.id}] Client disconnected")
+            logger.info(f"[{current_user.email}][{conv_id}] Client disconnected")
+            raise
+        except asyncio.TimeoutError:
+            logger.warning(f"[{current_user.email}][{conv_id}] No chunk for {STREAM_IDLE_TIMEOUT}s — aborting")
+            yield _sse({"type": "error", "message": "The response timed out. Please try again."})
         except Exception as e:
             logger.error(f"[STREAM] Generator error: {e}", exc_info=True)
-            err = json.dumps({"type": "error", "message": "An error occurred. Please try again."})
-            yield f"data: {err}\n\n"
-
-        # ── Persist assistant response using a fresh session ──
-        if full_response:
-            try:
-                from database import AsyncSessionLocal
-                async with AsyncSessionLocal() as save_session:
-                    c = await save_session.get(Conversation, conv.id)
-                    if c:
-                        save_session.add(Message(
-                            conversation_id = c.id,
-                            role            = "assistant",
-                            content         = full_response,
-                        ))
-                        if c.title == "New Conversation":
-                            c.title = user_message[:50] + ("..." if len(user_message) > 50 else "")
-                        c.updated_at = datetime.now(timezone.utc)
-                        await save_session.commit()
-                        logger.info(f"[{current_user.email}][{conv.id}] Saved: {full_response[:80]}")
-            except Exception as e:
-                logger.error(f"[STREAM] Save failed: {e}", exc_info=True)
-
-        done = json.dumps({"type": "done", "conversation_id": conv.id})
-        yield f"data: {done}\n\n"
+            yield _sse({"type": "error", "message": "An error occurred. Please try again."})
+        finally:
+            # Runs on disconnect too (task cancelled or generator closed) — the
+            # shield keeps these awaits from being cancelled, so the turn is saved.
+            with anyio.CancelScope(shield=True):
+                await stream.aclose()
+                await persist_turn(full_response)
+
+        yield _sse({"type": "done", "conversation_id": conv_id})
 
     return StreamingResponse(
         event_generator(),
@@ -335,7 +445,13 @@ async def handle_prompt_stream(
 # ─── Static frontend ───────────────────────────────────────────────────────────
 frontend_path = Path(__file__).parent.parent.parent / "frontend"
 if frontend_path.exists():
-    app.mount("/", StaticFiles(directory=str(frontend_path), html=True), name="frontend")
+    # gzip only the static app — wrapping the whole app would buffer SSE frames.
+    # StaticFiles already answers If-None-Match / If-Modified-Since with 304.
+    app.mount(
+        "/",
+        GZipMiddleware(StaticFiles(directory=str(frontend_path), html=True), minimum_size=1024),
+        name="frontend",
+    )
     logger.info(f"Serving frontend from {frontend_path}")
 else:
     logger.warning(f"Frontend not found at {frontend_path}")
@@ -3,10 +3,14 @@ load_dotenv('.env')
 
 import os
 import re
+import uuid
+import atexit
 import shutil
 import subprocess
 import tempfile
+import threading
 
+from cachetools import LRUCache, TTLCache
 from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain_core.tools import tool
 
@@ -15,6 +19,17 @@ from langchain_core.tools import tool
 from logger import get_logger
 logger = get_logger(__name__)
 
+# ─── Result caches ────────────────────────────────────────────────────────────
+# Tools run in worker threads (asyncio.to_thread), so cache access is locked.
+# Search results go stale; syntax validation is a pure function of the source.
+_cache_lock   = threading.Lock()
+_search_cache = TTLCache(maxsize=256, ttl=int(os.getenv("SEARCH_CACHE_TTL", "600")))
+_syntax_cache = LRUCache(maxsize=1024)
+
+# One scratch dir for the process; calls use unique file names inside it
+_MMDC_TMP = tempfile.mkdtemp(prefix="mmdc_")
+atexit.register(shutil.rmtree, _MMDC_TMP, ignore_errors=True)
+
 # ─── Tavily search ────────────────────────────────────────────────────────────
 tavily = TavilySearchResults(max_results=2)
 
@@ -31,6 +46,11 @@ def web_search_tool(query: str) -> str:
     Returns:
         Formatted search results as plain text.
     """
+    with _cache_lock:
+        cached = _search_cache.get(query)
+    if cached:
+        return cached
+
     results = tavily.invoke({"query": query})
     formatted = []
     for r in results:
@@ -38,19 +58,36 @@ def web_search_tool(query: str) -> str:
         content = r.get("content", "")
         url     = r.get("url", "")
         formatted.append(f"{title}\n{content}\nSource: {url}")
-    return "\n\n".join(formatted)
+    text = "\n\n".join(formatted)
+
+    # Empty results are usually transient (rate limit, outage) — don't pin them
+    if text:
+        with _cache_lock:
+            _search_cache[query] = text
+    return text
 
 
 # ─── Mermaid syntax check ─────────────────────────────────────────────────────
 
+# Compiled once per process rather than looked up on every call
+_RE_FILE_URL     = re.compile(r"file:///+[A-Za-z]:/[^\s\n]+")
+_RE_WIN_PATH     = re.compile(r"[A-Za-z]:\\[^\s\n]+")
+_RE_EMPTY_PARENS = re.compile(r"\(\s*\)")
+_RE_SPACES       = re.compile(r"\s{2,}")
+
+
+# mmdc output for a genuine syntax problem (vs. a Chromium/puppeteer failure)
+_RE_PARSE_ERROR = re.compile(r"Parse error|Lexical error|No diagram type detected|UnknownDiagramError")
+
+
 def _clean_mermaid_error(error: str) -> str:
     """Strip local file-system paths from mmdc error output."""
     if not error:
         return error
-    error = re.sub(r"file:///+[A-Za-z]:/[^\s\n]+", "path)", error)
-    error = re.sub(r"[A-Za-z]:\\[^\s\n]+",          "path)", error)
-    error = re.sub(r"\(\s*\)", "",                   error)
-    error = re.sub(r"\s{2,}", " ",                   error)
+    error = _RE_FILE_URL.sub("path)",   error)
+    error = _RE_WIN_PATH.sub("path)",   error)
+    error = _RE_EMPTY_PARENS.sub("",    error)
+    error = _RE_SPACES.sub(" ",         error)
     return error.strip()
 
 
@@ -64,14 +101,20 @@ def mermaid_syntax_check(mermaid_code: str) -> dict:
     Returns:
         {"valid": bool, "error": str | None}
     """
+    with _cache_lock:
+        cached = _syntax_cache.get(mermaid_code)
+    if cached is not None:
+        return dict(cached)
+
     mmdc = shutil.which("mmdc") or shutil.which("mmdc.cmd")
     if not mmdc:
         return {"valid": False, "error": "Mermaid CLI (mmdc) not found in PATH"}
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        mmd_file = os.path.join(tmpdir, "diagram.mmd")
-        out_file = os.path.join(tmpdir, "out.svg")
-
+    # mmdc infers the renderer from the extension, so the output must be a real .svg path
+    stem     = os.path.join(_MMDC_TMP, uuid.uuid4().hex)
+    mmd_file = stem + ".mmd"
+    out_file = stem + ".svg"
+    try:
         with open(mmd_file, "w", encoding="utf-8") as f:
             f.write(mermaid_code)
 
@@ -88,8 +131,23 @@ def mermaid_syntax_check(mermaid_code: str) -> dict:
             return {"valid": False, "error": "Mermaid CLI timed out. Try a simpler diagram."}
         except FileNotFoundError:
             return {"valid": False, "error": f"Could not execute mmdc at path: {mmdc}"}
-
-        if result.returncode != 0:
-            return {"valid": False, "error": _clean_mermaid_error(result.stderr)}
-
-        return {"valid": True, "error": None}
\ No newline at end of file
+    finally:
+        for path in (mmd_file, out_file):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Only real parse verdicts are cached — renderer crashes, timeouts and a
+    # missing CLI say nothing about the source and are retried next call
+    if result.returncode != 0:
+        verdict = {"valid": False, "error": _clean_mermaid_error(result.stderr)}
+        if not _RE_PARSE_ERROR.search(result.stderr or ""):
+            logger.warning(f"[mermaid_syntax_check] mmdc failed without a parse error: {verdict['error']}")
+            return verdict
+    else:
+        verdict = {"valid": True, "error": None}
+
+    with _cache_lock:
+        _syntax_cache[mermaid_code] = verdict
+    return dict(verdict)
\ No newline at end of file
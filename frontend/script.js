@@ -478,6 +478,11 @@ const sendMessage = async () => {
                         renderStreamedContent(botBubble, streamBuffer);
                         chatBox.scrollTop = chatBox.scrollHeight;
 
+                    } else if (event.type === 'reset') {
+                        // Server withdrew a draft (e.g. diagram before validation)
+                        streamBuffer        = '';
+                        botBubble.innerHTML = '';
+
                     } else if (event.type === 'done') {
                         botBubble.classList.remove('streaming');
                         await loadConversations();